@@ -1,40 +1,423 @@
+import concurrent.futures
 import os
-import pathlib
 import shutil
-import xml.etree.ElementTree as ET
+import threading
+import time
 import sqlite3
+import sys
+from email.utils import parsedate_to_datetime
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from html2txt import converters
+try:
+    from lxml import etree as ET
+    # lxml can keep going past a malformed item instead of abandoning the rest of the feed
+    ITERPARSE_OPTIONS = {'recover': True, 'huge_tree': False}
+except ImportError:
+    import xml.etree.ElementTree as ET
+    ITERPARSE_OPTIONS = {}
+
+
+# http status codes that are worth retrying after a pause
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# (connect, read) seconds, so a stalled server fails the show instead of hanging the run
+TIMEOUT = (10, 30)
+
+# characters that are not allowed in a show's file name, removed in one pass by str.translate
+BAD_TITLE_CHARACTERS = str.maketrans('', '', '\\/:.+?*')
+
+# (divisor, unit) for each power of 1024, indexed straight from the size's bit length
+SIZE_UNITS = [(1.0, 'B'), (1024.0, 'KB'), (1024.0 ** 2, 'MB'), (1024.0 ** 3, 'GB'), (1024.0 ** 4, 'TB'),
+              (1024.0 ** 5, 'PB')]
+
+# one converter shared by every show instead of a new one per feed item
+HTML2MARKDOWN = converters.Html2Markdown()
+
+
+def humanize_size(size):
+    index = min(max(0, (size.bit_length() - 1) // 10), len(SIZE_UNITS) - 1)
+    divisor, unit = SIZE_UNITS[index]
+    return f'{size / divisor:.2f} {unit}'
+
+
+def requests_get_with_retry(session, url, retries=5, backoff=1.0, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    for attempt in range(retries):
+        r = session.get(url, **kwargs)
+        if r.status_code not in RETRY_STATUS_CODES or attempt == retries - 1:
+            r.raise_for_status()
+            return r
+        r.close()
+        time.sleep(backoff * 2 ** attempt)
+
+
+# printing every chunk costs a flushed write per block, so progress is only reported a few times a second
+class Progress():
+
+    def __init__(self, name, totallength, interval=0.25):
+        self.name = name
+        totallength = float(totallength)
+        self.scale = 100.0 / totallength if totallength else 0.0
+        self.interval = interval
+        self.done = 0
+        self.last = 0.0
+        self.lock = threading.Lock()
+        # set when one part of a download has failed, so the others stop instead of finishing for nothing
+        self.abort = threading.Event()
+
+    def update(self, size):
+        with self.lock:
+            self.done += size
+            now = time.monotonic()
+            if now - self.last >= self.interval:
+                self.last = now
+                self.show()
+
+    def show(self):
+        print(f'{self.name} completed {self.done * self.scale:3.2f}% {humanize_size(self.done)}', end='\r',
+              flush=True)
+
+
+# set when the program is leaving early, so downloads already running stop too
+stopping = threading.Event()
+
+
+# file wrapper that reports what is written, so shutil.copyfileobj can stream straight into it
+class ProgressWriter():
+
+    def __init__(self, fd, progress):
+        self.fd = fd
+        self.progress = progress
+        self.written = 0
+
+    def write(self, chunk):
+        if self.progress.abort.is_set() or stopping.is_set():
+            raise requests.RequestException('download abandoned')
+        written = self.fd.write(chunk)
+        self.written += len(chunk)
+        self.progress.update(len(chunk))
+        return written
+
+
+def preallocate(fd, length):
+    # reserve the whole file up front so the filesystem can lay it out in one piece
+    if not length:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd.fileno(), 0, length)
+            return
+        except OSError:
+            pass
+    # without fallocate, setting the size still lets the filesystem plan the allocation
+    fd.truncate(length)
+
+
+def dropcache(fd, offset=0, length=0):
+    # a finished show is not read back soon, so write it out and let the kernel drop it from the page cache
+    if hasattr(os, 'posix_fadvise'):
+        fd.flush()
+        os.fsync(fd.fileno())
+        os.posix_fadvise(fd.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def rangelength(session, url):
+    # a one byte range request tells us both whether the server honours ranges and the full length
+    r = requests_get_with_retry(session, url, stream=True, headers={'Range': 'bytes=0-0'})
+    r.close()
+    if r.status_code != 206:
+        return None
+    totallength = r.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(totallength) if totallength.isdigit() else None
+
+
+def readsource(downloadfilename):
+    # the url and length a .part was started from, so it is only ever continued with the same show
+    try:
+        with open(downloadfilename + '.source') as fd:
+            url, totallength = fd.read().split('\n')[:2]
+        return url, int(totallength)
+    except (FileNotFoundError, ValueError):
+        return None, None
+
+
+def writesource(downloadfilename, url, totallength):
+    with open(downloadfilename + '.source', 'w') as fd:
+        fd.write(f'{url}\n{totallength or ""}\n')
+
+
+def removesource(downloadfilename):
+    try:
+        os.remove(downloadfilename + '.source')
+    except FileNotFoundError:
+        pass
+
+
+def download_range(session, url, downloadfilename, start, end, blocksize, progress, received, part):
+    request = requests_get_with_retry(session, url, stream=True, headers={'Range': f'bytes={start}-{end}'})
+    if request.status_code != 206:
+        request.close()
+        raise requests.RequestException(f'range {start}-{end} was not honoured by the server')
+    request.raw.decode_content = True
+    writer = None
+    try:
+        with open(downloadfilename, 'r+b', buffering=blocksize) as fd:
+            fd.seek(start)
+            writer = ProgressWriter(fd, progress)
+            shutil.copyfileobj(request.raw, writer, blocksize)
+            dropcache(fd, start, end - start + 1)
+    finally:
+        request.close()
+        # how much of this range is really on disk, for trimming the file to what can be resumed
+        if writer is not None:
+            received[part] = writer.written
+    # the file is preallocated, so a range that ends early would otherwise leave zeros that look like data
+    if writer.written != end - start + 1:
+        raise requests.RequestException(f'range {start}-{end} ended after {writer.written} bytes')
+
+
+def download_parallel_ranges(session, url, downloadfilename, totallength, parts, blocksize, progress):
+    with open(downloadfilename, 'wb') as fd:
+        preallocate(fd, totallength)
+    writesource(downloadfilename, url, totallength)
+    partlength = -(-totallength // parts)
+    spans = [(start, min(start + partlength, totallength) - 1) for start in range(0, totallength, partlength)]
+    received = [0] * len(spans)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parts) as executor:
+            ranges = [executor.submit(download_range, session, url, downloadfilename, start, end, blocksize,
+                                      progress, received, part)
+                      for part, (start, end) in enumerate(spans)]
+            try:
+                for result in concurrent.futures.as_completed(ranges):
+                    result.result()
+            except BaseException:
+                progress.abort.set()
+                raise
+    except BaseException:
+        # keep only the unbroken run of bytes from the start, so the next run can resume from the file's size
+        prefix = 0
+        for (start, end), size in zip(spans, received):
+            prefix += size
+            if size != end - start + 1:
+                break
+        if prefix:
+            os.truncate(downloadfilename, prefix)
+        else:
+            os.remove(downloadfilename)
+            removesource(downloadfilename)
+        raise
+
+
+def download_stream(session, show, blocksize, name, offset, sourcelength):
+    # a .part left by an earlier failed attempt is continued from where it stopped
+    request = None
+    if offset:
+        try:
+            request = requests_get_with_retry(session, show.url, stream=True, headers={'Range': f'bytes={offset}-'})
+        except requests.HTTPError as e:
+            # 416 means the partial file no longer fits the show, so it is fetched again from the start
+            if e.response is None or e.response.status_code != 416:
+                raise
+            e.response.close()
+        else:
+            if request.status_code == 200:
+                # the server ignored the range and is sending the whole show
+                offset = 0
+            else:
+                contentrange = request.headers.get('Content-Range', '')
+                totallength = contentrange.rpartition('/')[2]
+                # only append to a .part that was started from this same show at this same length
+                if not contentrange.startswith(f'bytes {offset}-') or totallength != str(sourcelength):
+                    request.close()
+                    request = None
+    if request is None:
+        offset = 0
+        request = requests_get_with_retry(session, show.url, stream=True)
+    # the server's length is exact, the feed's length is the fallback
+    if offset:
+        contentlength = request.headers['Content-Range'].rpartition('/')[2]
+    else:
+        contentlength = request.headers.get('Content-Length', '')
+    exactlength = contentlength.isdigit()
+    totallength = int(contentlength) if exactlength else show.urllengthint
+    progress = Progress(name, totallength or 0)
+    progress.done = offset
+    request.raw.decode_content = True
+    try:
+        # not preallocated, so even after a hard kill the file's size is exactly what a resume needs
+        with open(show.downloadfilename, 'ab' if offset else 'wb', buffering=blocksize) as fd:
+            if not offset:
+                writesource(show.downloadfilename, show.url, totallength if exactlength else None)
+            shutil.copyfileobj(request.raw, ProgressWriter(fd, progress), blocksize)
+            dropcache(fd)
+    finally:
+        request.close()
+    # a stream that closed cleanly but early stays a .part, so the next run resumes it
+    if exactlength and progress.done != totallength:
+        raise requests.RequestException(f'received {progress.done} of {totallength} bytes')
+    return progress
+
+
+def download_show(session, show, blocksize, parts):
+    url = show.url
+    downloadfilename = show.downloadfilename
+    name = os.path.basename(show.outputFilename)
+    # one stat tells both whether there is a partial file to resume and where it stopped
+    try:
+        offset = os.stat(downloadfilename).st_size
+    except FileNotFoundError:
+        offset = 0
+    sourceurl, sourcelength = readsource(downloadfilename) if offset else (None, None)
+    if sourceurl != url:
+        # a .part from another url, or with no record of where it came from, can't be trusted to continue
+        offset = 0
+    totallength = rangelength(session, url) if parts > 1 and not offset else None
+    if totallength:
+        progress = Progress(name, totallength)
+        download_parallel_ranges(session, url, downloadfilename, totallength, parts, blocksize, progress)
+    else:
+        progress = download_stream(session, show, blocksize, name, offset, sourcelength)
+    progress.show()
+    os.replace(downloadfilename, show.outputFilename)
+    removesource(downloadfilename)
+    return show.outputFilename
 
 
 class Data():
 
 
     def __init__(self):
+        sql_pragma = """
+        pragma journal_mode=wal;
+        pragma synchronous=normal;
+        pragma busy_timeout=5000;
+        pragma cache_size=-20000;
+        pragma temp_store=memory;
+        """
         sql_create = """
-        create table if not exists file (filename text unique);
+        create table if not exists file (filename text primary key) without rowid;
+        create table if not exists meta (key text primary key, value text);
+        """
+        # version 1 keys the file table directly on filename instead of a rowid table plus a unique index
+        sql_migrate = """
+        begin immediate;
+        create table file_new (filename text primary key) without rowid;
+        insert or ignore into file_new (filename) select filename from file;
+        drop table file;
+        alter table file_new rename to file;
+        pragma user_version=1;
+        commit;
         """
-        self.data = sqlite3.connect('dltwit.sqlite')
+        # autocommit, with writes wrapped in begin immediate so the write lock is taken up front
+        self.data = sqlite3.connect('dltwit.sqlite', isolation_level=None)
+        self.data.executescript(sql_pragma)
+        # a new database is created in the current shape, so only an existing one can need migrating
+        existed = self.data.execute("select 1 from sqlite_master where type='table' and name='file'").fetchone()
         self.data.executescript(sql_create)
-
-    def isfilename(self, filename):
+        if not existed:
+            self.data.execute('pragma user_version=1')
+        elif self.data.execute('pragma user_version').fetchone()[0] < 1:
+            self.data.executescript(sql_migrate)
+        # the whole table fits in memory, so lookups never have to go back to sqlite
         sql_select = """
-        select count(*) from file where filename=?
+        select filename from file
         """
-        row = self.data.execute(sql_select, (filename,))
-        result = row.fetchone()
-        return result[0] > 0
+        self.filenames = {row[0] for row in self.data.execute(sql_select)}
+        # filenames added but not yet written, committed together by flush
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # anything still pending would be lost with the connection
+        self.flush()
+        self.data.close()
+
+    def isfilename(self, filename):
+        return filename in self.filenames
 
     def addfilename(self, filename):
-        sql_insert ="""
-insert into file (filename)
+        self.filenames.add(filename)
+        self.pending.append(filename)
+        if len(self.pending) >= 50:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.addfilenames(self.pending)
+            self.pending = []
+
+    def addfilenames(self, filenames):
+        sql_insert = """
+insert or ignore into file (filename)
 values (?);        """
-        self.data.execute(sql_insert, (filename,))
-        self.data.commit()
+        with self.data:
+            self.data.execute('begin immediate')
+            self.data.executemany(sql_insert, [(filename,) for filename in filenames])
+        self.filenames.update(filenames)
+
+    def getmeta(self, key):
+        sql_select = """
+        select value from meta where key=?
+        """
+        row = self.data.execute(sql_select, (key,)).fetchone()
+        return row[0] if row else None
+
+    def setmeta(self, key, value):
+        sql_insert = """
+insert or replace into meta (key, value)
+values (?, ?);        """
+        with self.data:
+            self.data.execute('begin immediate')
+            self.data.execute(sql_insert, (key, value))
+
+# one feed item; each show gets its own so downloads running in other threads never see the next item's values
+class Episode():
+
+    __slots__ = ('title', 'pubDate', 'pubDateStr', 'descriptionhtml', '_description', 'url', 'urllength', 'urllengthint',
+                 'urltype', 'outputFilename', 'downloadfilename')
+
+    def __init__(self, title, pubDate, descriptionhtml, url, urllength, urltype, outputFilename):
+        self.title = title
+        # parsed once here so later comparisons never reparse the rfc 822 text, which is kept for printing
+        self.pubDateStr = pubDate
+        try:
+            self.pubDate = parsedate_to_datetime(pubDate)
+        except (TypeError, ValueError):
+            self.pubDate = None
+        self.descriptionhtml = descriptionhtml
+        self._description = None
+        self.url = url
+        self.urllength = urllength
+        self.urllengthint = int(urllength) if urllength.isdigit() else None
+        self.urltype = urltype
+        self.outputFilename = outputFilename
+        self.downloadfilename = outputFilename + '.part'
+
+    @property
+    def description(self):
+        # only shows that are about to be downloaded print their description, so convert it on first use
+        if self._description is None:
+            # text without any markup has nothing to convert, so skip the html parser entirely
+            if '<' not in self.descriptionhtml:
+                self._description = self.descriptionhtml
+            else:
+                self._description = HTML2MARKDOWN.convert(self.descriptionhtml)
+        return self._description
+
 
 class Shows():
 
-    def __init__(self):
+    def __init__(self, data):
+        self.data = data
         try:
             self.url = os.environ['twitcluburl']
         except KeyError:
@@ -48,54 +431,113 @@ class Shows():
             self.twitclubdestination = os.environ['twitclubdestination']
         except KeyError:
             self.twitclubdestination = os.path.abspath('./')
-        r = requests.get(self.url)
-        self.root = ET.fromstring(r.text)
+        try:
+            self.workers = int(os.environ['twitclubworkers'])
+        except KeyError:
+            self.workers = 5
+        try:
+            self.parts = int(os.environ['twitclubparts'])
+        except KeyError:
+            self.parts = 4
+        # one pooled session for the feed and every show so connections are kept alive and reused
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(10, self.workers * self.parts),
+                              max_retries=Retry(connect=3, read=3, backoff_factor=1.0))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # ask the server to skip the feed when it has not changed since the last complete run
+        headers = {}
+        etag = self.data.getmeta('etag')
+        lastmodified = self.data.getmeta('lastmodified')
+        if etag:
+            headers['If-None-Match'] = etag
+        if lastmodified:
+            headers['If-Modified-Since'] = lastmodified
+        self.feed = requests_get_with_retry(self.session, self.url, stream=True, headers=headers)
+        if self.feed.status_code == 304:
+            print('feed has not changed since the last run')
+            self.context = iter(())
+        else:
+            self.feed.raw.decode_content = True
+            self.context = ET.iterparse(self.feed.raw, events=('start', 'end'), **ITERPARSE_OPTIONS)
+
+    def savefeedvalidators(self):
+        # a feed lxml had to recover from may have lost items, so it is fetched in full again next run
+        if getattr(self.context, 'error_log', None):
+            print(f'feed had errors, it will be checked again next run: {self.context.error_log}')
+            return
+        if self.feed.status_code == 200:
+            self.data.setmeta('etag', self.feed.headers.get('ETag'))
+            self.data.setmeta('lastmodified', self.feed.headers.get('Last-Modified'))
 
     def shows(self):
-        for show in self.root.iter('item'):
-            self.description = converters.Html2Markdown().convert(show.find('description').text)
-            self.title = self.cleanTitle(show.find('title').text)
-            self.pubDate = show.find('pubDate').text
-            self.enclosure = show.find('enclosure')
-            self.url = shows.enclosure.attrib['url']
-            self.urllength = shows.enclosure.attrib['length']
-            self.urltype = shows.enclosure.attrib['type']
-            self.filename = shows.title + '.mp4'
-            self.outputFilename = os.path.join(shows.twitclubdestination, self.filename)
-            self.downloadfilename = os.path.join(shows.twitclubdestination, 'twitclubdownload')
-            yield show
+        # items are handled as soon as their end tag is parsed and then dropped from the tree
+        channel = None
+        for event, show in self.context:
+            if event == 'start':
+                if show.tag == 'channel':
+                    channel = show
+                continue
+            if show.tag != 'item':
+                continue
+            # an empty <title/>, or one made only of removed characters, would otherwise give a hidden '.mp4'
+            title = self.cleanTitle(show.findtext('title') or '') or 'Untitled'
+            enclosure = show.find('enclosure').attrib
+            yield Episode(title, show.findtext('pubDate', ''), show.findtext('description', ''),
+                          enclosure['url'], enclosure['length'], enclosure.get('type', ''),
+                          os.path.join(self.twitclubdestination, title + '.mp4'))
+            show.clear()
+            if channel is not None:
+                channel.remove(show)
+        self.feed.close()
 
     def cleanTitle(self, title):
-        newTitle = str(title)
-        badCharacters = '\\/:.+?*'
-        for badCharacter in badCharacters:
-            newTitle = newTitle.replace(badCharacter, '')
-        return newTitle
+        return str(title).translate(BAD_TITLE_CHARACTERS)
 
 
 if __name__ == '__main__':
-    shows = Shows()
-    twitclubblocksize = shows.blocksize
-    for show in shows.shows():
-        filename = shows.filename
-        outputFilename = shows.outputFilename
-        downloadfilename = shows.downloadfilename
-        data=Data()
-        if not data.isfilename(outputFilename):
-            if not pathlib.Path(outputFilename).exists():
-                print(f'title: {shows.title} {shows.pubDate}')
-                print(f'descrition: {shows.description}')
-                print(f'url: {shows.url} length: {shows.urllength} type: {shows.urltype}')
-                print(outputFilename)
-                request = requests.get(shows.url, stream=True)
-                requestSizeRead = 0
-                with open('twitclubdownload', 'wb') as fd:
-                    for chunk in request.iter_content(chunk_size=twitclubblocksize):
-                        fd.write(chunk)
-                        requestSizeRead += len(chunk)
-                        print(f'completed {(float(requestSizeRead) / float(shows.urllength) * 100):3.2f}%', end='\r',
-                              flush=True)
-                    print()
-                request.close()
-                shutil.move('twitclubdownload', outputFilename)
-                data.addfilename(outputFilename)
+    with Data() as data:
+        shows = Shows(data)
+        twitclubblocksize = shows.blocksize
+        # one directory scan instead of a stat per feed item
+        try:
+            existing = {entry.name for entry in os.scandir(shows.twitclubdestination)}
+        except FileNotFoundError:
+            existing = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=shows.workers) as executor:
+            downloads = {}
+            # a feed can list the same show twice, and both would write the same .part
+            submitted = set()
+            try:
+                for show in shows.shows():
+                    if not data.isfilename(show.outputFilename) and show.outputFilename not in submitted:
+                        if os.path.basename(show.outputFilename) not in existing:
+                            print(f'title: {show.title} {show.pubDateStr}')
+                            print(f'descrition: {show.description}')
+                            print(f'url: {show.url} length: {show.urllength} type: {show.urltype}')
+                            print(show.outputFilename)
+                            download = executor.submit(download_show, shows.session, show, twitclubblocksize, shows.parts)
+                            downloads[download] = show.outputFilename
+                            submitted.add(show.outputFilename)
+                failed = 0
+                for download in concurrent.futures.as_completed(downloads):
+                    try:
+                        data.addfilename(download.result())
+                    except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+                        print(f'\nfailed {downloads[download]}: {e}')
+                        failed += 1
+                        continue
+                    print(f'\nfinished {downloads[download]}')
+            except BaseException:
+                # don't wait for the queued shows on the way out, and stop the running ones at their next write
+                for download in downloads:
+                    download.cancel()
+                stopping.set()
+                raise
+            data.flush()
+            # only trust the feed's etag once every show in it was handled, so failed shows are retried next run
+            if not failed:
+                shows.savefeedvalidators()
+    # a failed show is only printed above, so the exit status is what tells cron about it
+    if failed:
+        sys.exit(1)